@@ -0,0 +1,105 @@
+import subprocess
+from ipaddress import ip_address
+
+from vpn_slice import main
+from vpn_slice.linux import Iproute2Provider
+
+
+class FakeRouteProvider:
+    def __init__(self, routes, fail=False):
+        # {destination: [nexthop devices]}
+        self.routes = routes
+        self.fail = fail
+        self.removed = []
+
+    def get_multipath_routes(self, dev, table=None):
+        if self.fail:
+            raise subprocess.CalledProcessError(2, 'ip')
+        return [dest for dest, devs in self.routes.items() if dev in devs]
+
+    def remove_multipath_route(self, destination, *, dev, table=None):
+        self.routes[destination].remove(dev)
+        return len(self.routes[destination])
+
+    def remove_route(self, destination, *, table=None):
+        self.removed.append(destination)
+
+
+class FakeHostsProvider:
+    def __init__(self):
+        self.written = []
+
+    def write_hosts(self, host_map, name):
+        self.written.append((dict(host_map), name))
+        return 0
+
+
+class FakeFirewallProvider:
+    def deconfigure_firewall(self, device):
+        pass
+
+
+def disconnect(tundev, routes, tmp_path, monkeypatch, fail=False):
+    monkeypatch.setattr(main, 'worker_pidfile', lambda env: str(tmp_path / 'worker.pid'))
+    p, args, env = main.parse_args_and_env(['--multipath', 'corp'], {
+        'reason': 'disconnect', 'TUNDEV': tundev, 'VPNGATEWAY': '198.51.100.1'})
+    providers = {'route': FakeRouteProvider(routes, fail), 'hosts': FakeHostsProvider(), 'firewall': FakeFirewallProvider()}
+    main.do_disconnect(env, args, providers)
+    return providers
+
+
+def test_disconnect_with_peers(tmp_path, monkeypatch):
+    # another tunnel in the group still uses the routes, so the hosts
+    # entries and the route to the gateway must stay
+    routes = {'10.0.0.0/8': ['tun0', 'tun1'], '10.1.0.0/16': ['tun0']}
+    providers = disconnect('tun0', routes, tmp_path, monkeypatch)
+    assert routes == {'10.0.0.0/8': ['tun1'], '10.1.0.0/16': []}
+    assert providers['hosts'].written == []
+    assert providers['route'].removed == []
+
+
+def test_disconnect_last(tmp_path, monkeypatch):
+    routes = {'10.0.0.0/8': ['tun1']}
+    providers = disconnect('tun1', routes, tmp_path, monkeypatch)
+    assert routes == {'10.0.0.0/8': []}
+    assert providers['hosts'].written == [({}, 'corp')]
+    assert providers['route'].removed == [ip_address('198.51.100.1')]
+
+
+def test_disconnect_failure(tmp_path, monkeypatch):
+    # if we can't tell whether other tunnels remain, assume they do
+    providers = disconnect('tun0', {}, tmp_path, monkeypatch, fail=True)
+    assert providers['hosts'].written == []
+    assert providers['route'].removed == []
+
+
+def show_routes(monkeypatch, output):
+    # parse recorded output of ip route show, without needing ip
+    iproute = Iproute2Provider.__new__(Iproute2Provider)
+    iproute.iproute = 'ip'
+    monkeypatch.setattr(subprocess, 'check_output', lambda cl: output.encode())
+    return iproute._show_routes('proto', 'static')
+
+
+def test_show_routes_single(monkeypatch):
+    assert show_routes(monkeypatch, (
+        '10.0.0.0/8 dev tun0 scope link \n'
+        '192.168.1.0/24 via 10.0.0.1 dev tun0 \n'
+    )) == {'10.0.0.0/8': {'tun0': 1}, '192.168.1.0/24': {'tun0': 1}}
+
+
+def test_show_routes_multipath(monkeypatch):
+    assert show_routes(monkeypatch, (
+        '10.0.0.0/8 \n'
+        '\tnexthop dev tun0 weight 3 \n'
+        '\tnexthop dev tun1 weight 1 \n'
+        '10.1.0.0/16 dev tun1 scope link \n'
+    )) == {'10.0.0.0/8': {'tun0': 3, 'tun1': 1}, '10.1.0.0/16': {'tun1': 1}}
+
+
+def test_show_routes_typed(monkeypatch):
+    assert show_routes(monkeypatch, (
+        'unreachable 10.2.0.0/16 \n'
+        'blackhole 10.3.0.0/16 \n'
+        '10.4.0.0/16 dev tun0 scope link \n'
+    )) == {'10.2.0.0/16': {}, '10.3.0.0/16': {}, '10.4.0.0/16': {'tun0': 1}}
@@ -0,0 +1,122 @@
+import os
+import stat
+import sys
+from ipaddress import ip_address
+
+from vpn_slice.posix import DigProvider
+
+
+def dig_output(*records):
+    # the output of dig +noall +answer for a zone transfer of example.com
+    lines = []
+    for r in records:
+        if isinstance(r, int):
+            r = ('example.com.', 'SOA', 'ns1.example.com. admin.example.com. %d 3600 900 604800 86400' % r)
+        name, rtype, rdata = r
+        lines.append('%s\t\t3600\tIN\t%s\t%s\n' % (name, rtype, rdata))
+    return [l.encode() for l in lines]
+
+
+def a(host, address):
+    return ('%s.example.com.' % host, 'AAAA' if ':' in address else 'A', address)
+
+
+def parse(lines, serial=None, pattern='*'):
+    return DigProvider._parse_zone_transfer(lines, serial, pattern)
+
+
+def records(*pairs):
+    return [('%s.example.com' % host, ip_address(address)) for host, address in pairs]
+
+
+def test_axfr():
+    out = dig_output(7, a('foo', '10.0.0.1'), ('example.com.', 'NS', 'ns1.example.com.'),
+                     a('bar', 'fd00::1'), ('www.example.com.', 'CNAME', 'foo.example.com.'), 7)
+    assert parse(out) == (7, records(('foo', '10.0.0.1'), ('bar', 'fd00::1')), None)
+
+
+def test_axfr_pattern():
+    out = dig_output(7, a('foo', '10.0.0.1'), a('bar', '10.0.0.2'), 7)
+    assert parse(out, pattern='f*') == (7, records(('foo', '10.0.0.1')), None)
+
+
+def test_axfr_instead_of_ixfr():
+    # the server may send the whole zone in response to an IXFR request
+    out = dig_output(7, a('foo', '10.0.0.1'), 7)
+    assert parse(out, serial=5) == (7, records(('foo', '10.0.0.1')), None)
+
+
+def test_empty_axfr_instead_of_ixfr():
+    # a zone with no records besides its SOA looks like an IXFR with no deltas
+    assert parse(dig_output(7, 7), serial=5) == (7, [], None)
+
+
+def test_lone_soa():
+    # the zone hasn't changed since serial
+    assert parse(dig_output(7), serial=7) == (7, [], [])
+
+
+def test_ixfr():
+    out = dig_output(7,
+                     5, a('foo', '10.0.0.1'), 6, a('foo', '10.0.0.2'), a('bar', '10.0.0.3'),
+                     6, a('bar', '10.0.0.3'), 7, a('baz', '10.0.0.4'),
+                     7)
+    assert parse(out, serial=5) == (7, records(('foo', '10.0.0.2'), ('baz', '10.0.0.4')),
+                                    records(('foo', '10.0.0.1')))
+
+
+def test_ixfr_net_changes():
+    out = dig_output(9,
+                     # add qux, and delete then re-add foo
+                     5, a('foo', '10.0.0.1'), 6, a('foo', '10.0.0.1'), a('qux', '10.0.0.5'),
+                     # delete qux, which didn't exist before serial, and bar, which did
+                     6, a('qux', '10.0.0.5'), a('bar', '10.0.0.3'), 7,
+                     # re-add bar, then delete it again
+                     7, 8, a('bar', '10.0.0.3'),
+                     8, a('bar', '10.0.0.3'), 9,
+                     9)
+    assert parse(out, serial=5) == (9, [], records(('bar', '10.0.0.3')))
+
+
+def test_truncated():
+    assert parse(dig_output(7, a('foo', '10.0.0.1'))) is None
+    assert parse(dig_output(7, 5, a('foo', '10.0.0.1'), 6, a('foo', '10.0.0.2')), serial=5) is None
+    assert parse(dig_output(7, 5, a('foo', '10.0.0.1'), 7), serial=5) is None
+    assert parse([], serial=5) is None
+
+
+def test_failed_transfer():
+    # dig prints only a comment when the server refuses the transfer
+    assert parse([b'; Transfer failed.\n']) is None
+
+
+FAKE_DIG = '''#!%s
+import sys
+with open(%r, 'a') as f:
+    print(' '.join(sys.argv[1:]), file=f)
+if sys.argv[-1] == '@192.0.2.1':
+    print('; Transfer failed.')
+    sys.exit(9)
+sys.stdout.write(open(%r).read())
+'''
+
+
+def test_lookup_zone(tmp_path, monkeypatch):
+    # stand in for dig with a script which replays a recorded transfer
+    # from the second server, after the first one refuses it
+    log, output = tmp_path / 'log', tmp_path / 'output'
+    output.write_bytes(b''.join(dig_output(7, 5, a('foo', '10.0.0.1'), 7, a('foo', '10.0.0.2'), 7)))
+    dig = tmp_path / 'dig'
+    dig.write_text(FAKE_DIG % (sys.executable, str(log), str(output)))
+    dig.chmod(dig.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ.get('PATH', ''))
+
+    dns = DigProvider()
+    result = dns.lookup_zone('example.com', [ip_address('192.0.2.1'), ip_address('192.0.2.2')],
+                             bind_address=ip_address('10.0.0.100'), serial=5)
+    assert result == (7, records(('foo', '10.0.0.2')), records(('foo', '10.0.0.1')))
+    assert log.read_text().splitlines() == [
+        '+noall +answer -b 10.0.0.100 example.com ixfr=5 @192.0.2.1',
+        '+noall +answer -b 10.0.0.100 example.com ixfr=5 @192.0.2.2',
+    ]
+    assert dns.lookup_zone('example.com', [ip_address('192.0.2.1')]) is None
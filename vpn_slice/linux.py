@@ -1,9 +1,21 @@
+import ctypes
+import errno
+import fcntl
 import os
+import socket
+import struct
 import subprocess
+from contextlib import contextmanager
+from ipaddress import ip_address, ip_network
+from select import select
 from signal import SIGTERM
 import stat
+try:
+    from signal import pidfd_send_signal
+except ImportError:
+    pidfd_send_signal = None
 
-from .provider import FirewallProvider, ProcessProvider, RouteProvider, TunnelPrepProvider
+from .provider import FileWatchProvider, FirewallProvider, ProcessProvider, RouteMonitorProvider, RouteProvider, TunnelPrepProvider
 from .util import get_executable
 
 
@@ -22,9 +34,37 @@ class ProcfsProvider(ProcessProvider):
         except (OSError, ValueError, IOError):
             return None
 
+    def start_time_of(self, pid):
+        try:
+            info = open('/proc/%d/stat' % pid).read()
+        except (OSError, IOError):
+            return None
+        # starttime is the 22nd field; the 2nd (comm) may contain spaces
+        return info.rpartition(')')[2].split()[19]
+
     def kill(self, pid, signal=SIGTERM):
         os.kill(pid, signal)
 
+    def terminate(self, pid, timeout, signal=SIGTERM, start_time=None):
+        # A pidfd refers to this exact process even if its PID is reused,
+        # and becomes readable when it exits (Linux 5.3+, Python 3.9+).
+        if pidfd_send_signal is None:
+            return super().terminate(pid, timeout, signal, start_time)
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                raise
+            return super().terminate(pid, timeout, signal, start_time)
+        try:
+            # check the identity only once the pidfd has pinned the process
+            if start_time is not None and self.start_time_of(pid) != start_time:
+                raise ProcessLookupError("process %d has exited, or its PID was reused" % pid)
+            pidfd_send_signal(pidfd, signal)
+            return bool(select([pidfd], [], [], timeout)[0])
+        finally:
+            os.close(pidfd)
+
 
 class Iproute2Provider(RouteProvider):
     def __init__(self):
@@ -50,14 +90,14 @@ class Iproute2Provider(RouteProvider):
         else:
             subprocess.check_call(cl)
 
-    def add_route(self, destination, *, via=None, dev=None, src=None, mtu=None):
-        self._iproute('route', 'add', destination, via=via, dev=dev, src=src, mtu=mtu)
+    def add_route(self, destination, *, via=None, dev=None, src=None, mtu=None, table=None, nhid=None):
+        self._iproute('route', 'add', destination, via=via, dev=dev, src=src, mtu=mtu, table=table, nhid=nhid)
 
-    def replace_route(self, destination, *, via=None, dev=None, src=None, mtu=None):
-        self._iproute('route', 'replace', destination, via=via, dev=dev, src=src, mtu=mtu)
+    def replace_route(self, destination, *, via=None, dev=None, src=None, mtu=None, table=None, nhid=None):
+        self._iproute('route', 'replace', destination, via=via, dev=dev, src=src, mtu=mtu, table=table, nhid=nhid)
 
-    def remove_route(self, destination):
-        self._iproute('route', 'del', destination)
+    def remove_route(self, destination, *, table=None):
+        self._iproute('route', 'del', destination, table=table)
 
     def get_route(self, destination):
         return self._iproute('route', 'get', destination)
@@ -71,9 +111,136 @@ class Iproute2Provider(RouteProvider):
     def set_link_info(self, device, state, mtu=None):
         self._iproute('link', 'set', state, dev=device, mtu=mtu)
 
+    def set_link_queue(self, device, *, txqueuelen=None, qdisc=None):
+        if txqueuelen is not None:
+            self._iproute('link', 'set', dev=device, txqueuelen=txqueuelen)
+        if qdisc is not None:
+            # only needed for this, so don't require tc unless it's used
+            tc = get_executable('/sbin/tc')
+            subprocess.check_call([tc, 'qdisc', 'replace', 'dev', device, 'root', qdisc])
+
     def add_address(self, device, address):
         self._iproute('address', 'add', address, dev=device)
 
+    # Multipath routes are shared between several tunnels (and thus several
+    # vpn-slice processes), so the read-modify-write of their nexthops must
+    # be serialized. The kernel doesn't report the weight of a route with a
+    # single nexthop, so each tunnel's weight is also recorded in a file.
+    _MULTIPATH_LOCK = '/var/run/vpn-slice-multipath.lock'
+    _MULTIPATH_WEIGHTS = '/var/run/vpn-slice-multipath.weights'
+    _ROUTE_TYPES = ('unicast', 'local', 'broadcast', 'multicast', 'throw', 'unreachable', 'prohibit', 'blackhole', 'nat')
+
+    @contextmanager
+    def _multipath_lock(self):
+        with open(self._MULTIPATH_LOCK, 'a') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            yield
+
+    def _show_routes(self, *args, family=4):
+        """Parse the output of `ip route show` into a dict mapping
+        destinations to dicts of {nexthop device: weight}."""
+        cl = [self.iproute, '-%d' % family, 'route', 'show']
+        cl.extend(str(v) for v in args)
+        routes, dest = {}, None
+        for line in subprocess.check_output(cl).decode().splitlines():
+            words = line.split()
+            if not words:
+                continue
+            if not line[0].isspace():
+                if words[0] in self._ROUTE_TYPES:
+                    words = words[1:]
+                dest, words = words[0], words[1:]
+                routes[dest] = {}
+            elif words[0] != 'nexthop' or dest is None:
+                continue
+            if 'dev' in words:
+                weight = int(words[words.index('weight') + 1]) if 'weight' in words else 1
+                routes[dest][words[words.index('dev') + 1]] = weight
+        return routes
+
+    def _read_weights(self):
+        try:
+            with open(self._MULTIPATH_WEIGHTS) as f:
+                return {dev: int(weight) for dev, weight in (line.split() for line in f if line.strip())}
+        except (IOError, ValueError):
+            return {}
+
+    def _write_weights(self, weights):
+        with open(self._MULTIPATH_WEIGHTS, 'w') as f:
+            for dev, weight in sorted(weights.items()):
+                print(dev, weight, file=f)
+
+    def _get_nexthops(self, destination, table=None):
+        family = ip_network(destination, strict=False).version
+        routes = self._show_routes('exact', destination, 'table', table or 'main', family=family)
+        weights = self._read_weights()
+        return {dev: weights.get(dev, weight) for dev, weight in next(iter(routes.values()), {}).items()}
+
+    def _set_nexthops(self, destination, nexthops, table=None):
+        args = ['route', 'replace', destination, 'proto', 'static']
+        for dev, weight in sorted(nexthops.items()):
+            args.extend(('nexthop', 'dev', dev, 'weight', weight))
+        self._iproute(*args, table=table)
+
+    def add_multipath_route(self, destination, *, dev, weight=1, table=None):
+        with self._multipath_lock():
+            weights = self._read_weights()
+            if weights.get(dev) != weight:
+                weights[dev] = weight
+                self._write_weights(weights)
+            nexthops = self._get_nexthops(destination, table)
+            nexthops[dev] = weight
+            self._set_nexthops(destination, nexthops, table)
+
+    def remove_multipath_route(self, destination, *, dev, table=None):
+        with self._multipath_lock():
+            nexthops = self._get_nexthops(destination, table)
+            if dev in nexthops:
+                del nexthops[dev]
+                if nexthops:
+                    self._set_nexthops(destination, nexthops, table)
+                else:
+                    self.remove_route(destination, table=table)
+            return len(nexthops)
+
+    def get_multipath_routes(self, dev, table=None):
+        return [dest for dest, nexthops in self._show_routes('proto', 'static', 'table', table or 'main').items()
+                if dev in nexthops]
+
+    def replace_nexthop(self, nhid, *, via=None, dev=None):
+        # the kernel doesn't allow IPv6 routes to use IPv4 nexthops
+        self._iproute('-4', 'nexthop', 'replace', 'id', nhid, via=via, dev=dev)
+
+    def remove_nexthop(self, nhid):
+        self._iproute('nexthop', 'del', 'id', nhid)
+
+    def flush_table(self, table):
+        for family in (4, 6):
+            cl = [self.iproute, '-%d' % family, 'route', 'flush', 'table', str(table)]
+            p = subprocess.run(cl, stderr=subprocess.PIPE)
+            # the kernel only creates a table once it has routes of a family
+            if p.returncode and b'table does not exist' not in p.stderr:
+                raise subprocess.CalledProcessError(p.returncode, cl, stderr=p.stderr)
+
+    def _rule(self, action, table, uidrange, fwmark, src):
+        selectors = []
+        if uidrange is not None:
+            selectors.extend(('uidrange', '%d-%d' % uidrange))
+        if fwmark is not None:
+            selectors.extend(('fwmark', fwmark))
+        if src is not None:
+            selectors.extend(('from', src))
+        # UID and mark rules apply to both address families
+        families = (ip_address(src).version,) if src is not None else (4, 6)
+        for family in families:
+            self._iproute('-%d' % family, 'rule', action, *selectors, lookup=table)
+
+    def add_rule(self, table, *, uidrange=None, fwmark=None, src=None):
+        self._rule('add', table, uidrange, fwmark, src)
+
+    def remove_rule(self, table, *, uidrange=None, fwmark=None, src=None):
+        self._rule('del', table, uidrange, fwmark, src)
+
 
 class IptablesProvider(FirewallProvider):
     def __init__(self):
@@ -92,6 +259,193 @@ class IptablesProvider(FirewallProvider):
         self._iptables('-D', 'INPUT', '-i', device, '-j', 'DROP')
         self._iptables('-D', 'INPUT', '-i', device, '-m', 'state', '--state', 'RELATED,ESTABLISHED', '-j', 'ACCEPT')
 
+    def _cgroup_mark(self, action, device, cgroup, fwmark):
+        self._iptables('-t', 'mangle', action, 'OUTPUT', '-m', 'cgroup', '--path', cgroup, '-j', 'MARK', '--set-mark', fwmark)
+        self._iptables('-t', 'nat', action, 'POSTROUTING', '-o', device, '-m', 'mark', '--mark', fwmark, '-j', 'MASQUERADE')
+
+    def configure_cgroup_mark(self, device, cgroup, fwmark):
+        self._cgroup_mark('-A', device, cgroup, fwmark)
+
+    def deconfigure_cgroup_mark(self, device, cgroup, fwmark):
+        self._cgroup_mark('-D', device, cgroup, fwmark)
+
+    def configure_mss_clamp(self, device, mss):
+        target = ('--clamp-mss-to-pmtu',) if mss == 'pmtu' else ('--set-mss', str(mss))
+        self._iptables('-t', 'mangle', '-A', 'POSTROUTING', '-o', device, '-p', 'tcp', '--tcp-flags', 'SYN,RST', 'SYN', '-j', 'TCPMSS', *target)
+
+    def deconfigure_mss_clamp(self, device):
+        # The clamped MSS may have been derived from a guessed MTU, so find
+        # the rules to delete by their device rather than reconstructing them.
+        rules = subprocess.check_output([self.iptables, '-t', 'mangle', '-S', 'POSTROUTING']).decode()
+        removed = 0
+        for line in rules.splitlines():
+            words = line.split()
+            if words[:2] == ['-A', 'POSTROUTING'] and 'TCPMSS' in words and '-o' in words and words[words.index('-o') + 1] == device:
+                self._iptables('-t', 'mangle', '-D', *words[1:])
+                removed += 1
+        return removed
+
+
+class InotifyProvider(FileWatchProvider):
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.fd = None
+        self.watches = {}
+
+    def _libc(self, func, *args):
+        libc = ctypes.CDLL(None, use_errno=True)
+        res = getattr(libc, func)(*args)
+        if res < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return res
+
+    def watch_file(self, path):
+        if self.fd is None:
+            self.fd = self._libc('inotify_init1', self.IN_NONBLOCK | self.IN_CLOEXEC)
+
+        # Watch the containing directory, so that we also notice when the
+        # file is replaced by renaming another file over it.
+        dirname, basename = os.path.split(os.path.abspath(path))
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        wd = self._libc('inotify_add_watch', self.fd, os.fsencode(dirname), mask)
+        self.watches.setdefault(wd, set()).add(os.fsencode(basename))
+
+    def fileno(self):
+        return self.fd
+
+    def read_changes(self):
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = self._EVENT.unpack_from(buf, offset)
+                offset += self._EVENT.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if name in self.watches.get(wd, ()):
+                    changed = True
+
+
+class NetlinkRouteMonitorProvider(RouteMonitorProvider):
+    NETLINK_ROUTE = 0
+    SOL_NETLINK = 270
+    NETLINK_ADD_MEMBERSHIP = 1
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTMGRP_IPV6_ROUTE = 0x400
+    RTNLGRP_NEXTHOP = 32
+    RTM_NEWROUTE = 24
+    RTM_DELROUTE = 25
+    RTM_DELNEXTHOP = 105
+    NHA_ID = 1
+    RTN_UNICAST = 1
+    RTM_F_CLONED = 0x200
+    RTA_DST = 1
+    RTA_OIF = 4
+    RTA_TABLE = 15
+    _NLMSGHDR = struct.Struct('=IHHII')
+    _RTMSG = struct.Struct('=BBBBBBBBI')
+    _NHMSG = struct.Struct('=BBBBI')
+    _RTATTR = struct.Struct('=HH')
+
+    def __init__(self):
+        self.sock = None
+
+    def start_monitor(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC, self.NETLINK_ROUTE)
+        self.sock.bind((0, self.RTMGRP_IPV4_ROUTE | self.RTMGRP_IPV6_ROUTE))
+        # The kernel deletes the routes using a nexthop object along with it,
+        # without notifying us of each route.
+        try:
+            self.sock.setsockopt(self.SOL_NETLINK, self.NETLINK_ADD_MEMBERSHIP, self.RTNLGRP_NEXTHOP)
+        except OSError:
+            pass  # kernel too old to have nexthop objects
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_changes(self):
+        changes, lost = [], False
+        while True:
+            try:
+                buf = self.sock.recv(65536)
+            except BlockingIOError:
+                return None if lost else changes
+            except OSError as e:
+                # the socket buffer overflowed, and notifications were lost;
+                # keep draining it, since everything must be checked anyway
+                if e.errno != errno.ENOBUFS:
+                    raise
+                lost = True
+                continue
+
+            offset = 0
+            while offset + self._NLMSGHDR.size <= len(buf):
+                length, msgtype, flags, seq, pid = self._NLMSGHDR.unpack_from(buf, offset)
+                msg = buf[offset + self._NLMSGHDR.size:offset + length]
+                if msgtype in (self.RTM_NEWROUTE, self.RTM_DELROUTE):
+                    change = self._parse_route(msg)
+                    if change is not None:
+                        change['event'] = 'add' if msgtype == self.RTM_NEWROUTE else 'del'
+                        changes.append(change)
+                elif msgtype == self.RTM_DELNEXTHOP:
+                    nhid = self._parse_nexthop(msg)
+                    if nhid is not None:
+                        changes.append({'event': 'del', 'nexthop': nhid})
+                offset += (length + 3) & ~3
+
+    def _parse_nexthop(self, msg):
+        offset = self._NHMSG.size
+        while offset + self._RTATTR.size <= len(msg):
+            length, attrtype = self._RTATTR.unpack_from(msg, offset)
+            if length < self._RTATTR.size:
+                break
+            if attrtype == self.NHA_ID:
+                nhid, = struct.unpack_from('=I', msg, offset + self._RTATTR.size)
+                return nhid
+            offset += (length + 3) & ~3
+        return None
+
+    def _parse_route(self, msg):
+        family, dst_len, src_len, tos, table, protocol, scope, rtype, flags = self._RTMSG.unpack_from(msg)
+        if rtype != self.RTN_UNICAST or flags & self.RTM_F_CLONED or family not in (socket.AF_INET, socket.AF_INET6):
+            return None
+
+        dst = bytes(4 if family == socket.AF_INET else 16)
+        dev = None
+        offset = self._RTMSG.size
+        while offset + self._RTATTR.size <= len(msg):
+            length, attrtype = self._RTATTR.unpack_from(msg, offset)
+            if length < self._RTATTR.size:
+                break
+            data = msg[offset + self._RTATTR.size:offset + length]
+            if attrtype == self.RTA_DST:
+                dst = data
+            elif attrtype == self.RTA_OIF:
+                index, = struct.unpack('=I', data)
+                try:
+                    dev = socket.if_indextoname(index)
+                except OSError:
+                    dev = str(index)
+            elif attrtype == self.RTA_TABLE:
+                table, = struct.unpack('=I', data)
+            offset += (length + 3) & ~3
+
+        return {'destination': ip_network((dst, dst_len)), 'dev': dev, 'table': table}
+
 
 class CheckTunDevProvider(TunnelPrepProvider):
     def create_tunnel(self):
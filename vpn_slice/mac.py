@@ -14,7 +14,10 @@ class PsProvider(ProcessProvider):
         self.ps = get_executable('/bin/ps')
 
     def pid2exe(self, pid):
-        info = subprocess.check_output([self.lsof, '-p', str(pid)]).decode()
+        try:
+            info = subprocess.check_output([self.lsof, '-p', str(pid)]).decode()
+        except subprocess.CalledProcessError:
+            return None
         for line in info.splitlines():
             parts = line.split()
             if parts[3] == 'txt':
@@ -28,6 +31,12 @@ class PsProvider(ProcessProvider):
         except ValueError:
             return None
 
+    def start_time_of(self, pid):
+        try:
+            return subprocess.check_output([self.ps, '-p', str(pid), '-o', 'lstart=']).decode().strip() or None
+        except subprocess.CalledProcessError:
+            return None
+
     def kill(self, pid, signal=SIGTERM):
         os.kill(pid, signal)
 
@@ -43,7 +52,11 @@ class BSDRouteProvider(RouteProvider):
     def _ifconfig(self, *args):
         return subprocess.check_output([self.ifconfig] + list(map(str, args))).decode()
 
-    def add_route(self, destination, *, via=None, dev=None, src=None, mtu=None):
+    def add_route(self, destination, *, via=None, dev=None, src=None, mtu=None, table=None, nhid=None):
+        if table is not None:
+            raise NotImplementedError("routing tables are not supported on this platform")
+        if nhid is not None:
+            raise NotImplementedError("nexthop objects are not supported on this platform")
         args = ['add']
         if mtu is not None:
             args.extend(('-mtu', str(mtu)))
@@ -55,7 +68,9 @@ class BSDRouteProvider(RouteProvider):
 
     replace_route = add_route
 
-    def remove_route(self, destination):
+    def remove_route(self, destination, *, table=None):
+        if table is not None:
+            raise NotImplementedError("routing tables are not supported on this platform")
         self._route('delete', destination)
 
     def get_route(self, destination):
@@ -4,17 +4,21 @@ from __future__ import print_function
 from sys import stderr, platform
 import os, subprocess as sp
 import argparse
+from select import select
 from enum import Enum
 from itertools import chain
+from time import time
+from signal import SIGKILL
 from ipaddress import ip_network, ip_address, IPv4Address, IPv4Network, IPv6Address, IPv6Network, IPv6Interface
 
 from .version import __version__
+from .provider import FirewallProvider, RouteProvider
 from .util import slurpy
 
 
 def get_default_providers():
     if platform.startswith('linux'):
-        from .linux import ProcfsProvider, Iproute2Provider, IptablesProvider, CheckTunDevProvider
+        from .linux import ProcfsProvider, Iproute2Provider, IptablesProvider, CheckTunDevProvider, InotifyProvider, NetlinkRouteMonitorProvider
         from .posix import DigProvider, PosixHostsFileProvider
         return {
             'process': ProcfsProvider(),
@@ -23,6 +27,8 @@ def get_default_providers():
             'dns': DigProvider(),
             'hosts': PosixHostsFileProvider(),
             'prep': CheckTunDevProvider(),
+            'watch': InotifyProvider(),
+            'monitor': NetlinkRouteMonitorProvider(),
         }
     elif platform.startswith('darwin'):
         from .mac import PsProvider, BSDRouteProvider
@@ -52,6 +58,23 @@ def net_or_host_param(s):
             return s
 
 
+def read_routes_file(path):
+    routes = []
+    with open(path) as f:
+        for line in f:
+            routes.extend(net_or_host_param(w) for w in line.split('#', 1)[0].split())
+    return routes
+
+
+def mss_param(s):
+    if s in ('pmtu', 'mtu'):
+        return s
+    mss = int(s)
+    if mss <= 0:
+        raise argparse.ArgumentTypeError("MSS must be positive, not %d" % mss)
+    return mss
+
+
 def names_for(host, domains, short=True, long=True):
     if '.' in host: first, rest = host.split('.', 1)
     else: first, rest = host, None
@@ -66,12 +89,68 @@ def names_for(host, domains, short=True, long=True):
         elif rest in domains: names.append(first)
     return names
 
+def uidrange_param(s):
+    first, _, last = s.partition('-')
+    return int(first), int(last or first)
+
+def provider_supports(provider, base, method):
+    # optional provider methods raise NotImplementedError unless overridden
+    return getattr(type(provider), method) is not getattr(base, method)
+
+def add_vpn_route(env, args, providers, dest):
+    # IPv6 multipath nexthops need gateways, which tunnels don't have, so
+    # IPv6 routes are never shared and simply go through this device
+    if args.multipath and dest.version == 4:
+        providers['route'].add_multipath_route(dest, dev=env.tundev, weight=args.weight, table=args.table)
+    elif args.nexthop_id is not None and dest.version == 4:
+        providers['route'].replace_route(dest, nhid=args.nexthop_id, table=args.table)
+    else:
+        providers['route'].replace_route(dest, dev=env.tundev, table=args.table)
+
+def remove_vpn_route(env, args, providers, dest):
+    if args.multipath and dest.version == 4:
+        providers['route'].remove_multipath_route(dest, dev=env.tundev, table=args.table)
+    else:
+        providers['route'].remove_route(dest, table=args.table)
+
+def policy_rules(env, args):
+    # traffic from the VPN's own addresses (e.g. our DNS lookups) must
+    # always use the VPN routing table
+    rules = [dict(uidrange=r) for r in args.uid_range]
+    if args.cgroup:
+        rules.append(dict(fwmark=args.fwmark))
+    rules.extend(dict(src=a) for a in (env.myaddr, env.myaddr6) if a)
+    return rules
+
 ########################################
 
 def do_pre_init(env, args, providers):
     providers['prep'].create_tunnel()
     providers['prep'].prepare_tunnel()
 
+def worker_pidfile(env):
+    return '/var/run/vpn-slice-%s.pid' % env.tundev
+
+def write_worker_pidfile(env, providers, pid):
+    # record the worker's start time too, so that a stale pidfile can't
+    # lead us to kill an unrelated process which has reused its PID
+    with open(worker_pidfile(env), 'w') as f:
+        print(pid, file=f)
+        print(providers['process'].start_time_of(pid), file=f)
+
+def read_worker_pidfile(env):
+    with open(worker_pidfile(env)) as f:
+        return int(f.readline()), f.readline().strip()
+
+def terminate_process(args, providers, pid, start_time=None):
+    # SIGKILL anything that ignores SIGTERM for longer than --kill-timeout
+    process = providers['process']
+    if process.terminate(pid, args.kill_timeout, start_time=start_time):
+        return True
+    if args.verbose:
+        print("Process %d did not exit within %g seconds, sending SIGKILL" % (pid, args.kill_timeout), file=stderr)
+    return process.terminate(pid, args.kill_timeout, SIGKILL, start_time=start_time)
+
 def do_disconnect(env, args, providers):
     for pidfile in args.kill:
         try:
@@ -79,22 +158,98 @@ def do_disconnect(env, args, providers):
         except (IOError, ValueError):
             print("WARNING: could not read pid from %s" % pidfile, file=stderr)
         else:
-            try: providers['process'].kill(pid)
+            try: exited = terminate_process(args, providers, pid)
             except OSError as e:
                 print("WARNING: could not kill pid %d from %s: %s" % (pid, pidfile, str(e)), file=stderr)
             else:
-                if args.verbose:
+                if not exited:
+                    print("WARNING: pid %d from %s did not exit even after SIGKILL" % (pid, pidfile), file=stderr)
+                elif args.verbose:
                     print("Killed pid %d from %s" % (pid, pidfile), file=stderr)
 
-    removed = providers['hosts'].write_hosts({}, args.name)
-    if args.verbose:
-        print("Removed %d hosts from /etc/hosts" % removed, file=stderr)
-
-    # delete explicit route to gateway
+    # cancel our post-connect worker, if it's still running, so that it
+    # can't add routes or hosts after we've cleaned them up
+    pidfile = worker_pidfile(env)
     try:
-        providers['route'].remove_route(env.gateway)
-    except sp.CalledProcessError:
-        print("WARNING: could not delete route to VPN gateway (%s)" % env.gateway, file=stderr)
+        pid, start_time = read_worker_pidfile(env)
+    except (IOError, ValueError):
+        pass
+    else:
+        try:
+            if not terminate_process(args, providers, pid, start_time):
+                print("WARNING: post-connect process (pid %d) did not exit even after SIGKILL" % pid, file=stderr)
+            elif args.verbose:
+                print("Cancelled post-connect process (pid %d)" % pid, file=stderr)
+        except ProcessLookupError:
+            # already exited, or the PID now belongs to another process
+            pass
+        try:
+            os.remove(pidfile)
+        except OSError:
+            pass
+
+    # remove this tunnel's nexthops from the shared multipath routes, leaving
+    # the other tunnels in the group undisturbed; the hosts entries and the
+    # gateway route are only cleaned up when the last tunnel disconnects
+    last = True
+    if args.multipath:
+        try:
+            dests = providers['route'].get_multipath_routes(env.tundev, table=args.table)
+            for dest in dests:
+                if providers['route'].remove_multipath_route(dest, dev=env.tundev, table=args.table):
+                    last = False
+        except sp.CalledProcessError:
+            # other tunnels may still be using the group, so leave its hosts and gateway route alone
+            last = False
+            print("WARNING: could not remove multipath routes for VPN interface (%s)" % env.tundev, file=stderr)
+        else:
+            if args.verbose:
+                print("Removed %s from %d multipath routes in group %s%s." % (
+                    env.tundev, len(dests), args.multipath, '' if last else ' (other tunnels remain)'), file=stderr)
+
+    # removing the shared nexthop object removes all of the routes using it
+    if args.nexthop_id is not None:
+        try:
+            providers['route'].remove_nexthop(args.nexthop_id)
+        except sp.CalledProcessError:
+            print("WARNING: could not remove nexthop object %d; check ip nexthop" % args.nexthop_id, file=stderr)
+        else:
+            if args.verbose:
+                print("Removed nexthop object %d and all routes using it." % args.nexthop_id, file=stderr)
+
+    if last:
+        removed = providers['hosts'].write_hosts({}, args.name)
+        if args.verbose:
+            print("Removed %d hosts from /etc/hosts" % removed, file=stderr)
+
+        # delete explicit route to gateway
+        try:
+            providers['route'].remove_route(env.gateway)
+        except sp.CalledProcessError:
+            print("WARNING: could not delete route to VPN gateway (%s)" % env.gateway, file=stderr)
+
+    # remove policy routing rules and cgroup marks, and the routes in the
+    # VPN routing table (including those restoring excluded subnets) unless
+    # other tunnels in the multipath group are still using them
+    if args.table:
+        if last:
+            try:
+                providers['route'].flush_table(args.table)
+            except sp.CalledProcessError:
+                print("WARNING: could not flush routing table %s; check ip route show table %s" % (args.table, args.table), file=stderr)
+            else:
+                if args.verbose:
+                    print("Flushed routing table %s." % args.table, file=stderr)
+        for rule in policy_rules(env, args):
+            try:
+                providers['route'].remove_rule(args.table, **rule)
+            except sp.CalledProcessError:
+                print("WARNING: could not remove policy routing rule %r for table %s; check ip rule" % (rule, args.table), file=stderr)
+        for cgroup in args.cgroup:
+            try:
+                providers['firewall'].deconfigure_cgroup_mark(env.tundev, cgroup, args.fwmark)
+            except sp.CalledProcessError:
+                print("WARNING: failed to remove iptables rules marking cgroup %s; check iptables -t mangle -S" % cgroup, file=stderr)
 
     # remove iptables rules for incoming traffic
     if not args.incoming:
@@ -103,13 +258,22 @@ def do_disconnect(env, args, providers):
         except sp.CalledProcessError:
             print("WARNING: failed to remove iptables rules for VPN interface (%s); check iptables -S" % env.tundev, file=stderr)
 
+    # remove TCP MSS clamping
+    if args.clamp_mss:
+        try:
+            removed = providers['firewall'].deconfigure_mss_clamp(env.tundev)
+            if args.verbose:
+                print("Removed %d TCP MSS clamping rules for VPN interface." % removed, file=stderr)
+        except sp.CalledProcessError:
+            print("WARNING: failed to remove TCP MSS clamping for VPN interface (%s); check iptables -t mangle -S" % env.tundev, file=stderr)
+
 def do_connect(env, args, providers):
     if args.banner and env.banner:
         print("Connect Banner:")
         for l in env.banner.splitlines(): print("| "+l)
 
     # set explicit route to gateway
-    gwr = providers['route'].get_route(env.gateway)
+    gwr = env.gateway_route = providers['route'].get_route(env.gateway)
     providers['route'].replace_route(
         env.gateway, **{k: gwr.get(k) for k in ('via', 'dev', 'src', 'mtu')})
 
@@ -141,6 +305,29 @@ def do_connect(env, args, providers):
             print("WARNING: guessing default MTU of %d (couldn't determine MTU of %s)" % (mtu, dev), file=stderr)
     providers['route'].set_link_info(env.tundev, state='up', mtu=mtu)
 
+    # tune the transmit queue, which is optional, so carry on without it
+    if args.txqueuelen is not None or args.qdisc:
+        try:
+            providers['route'].set_link_queue(env.tundev, txqueuelen=args.txqueuelen, qdisc=args.qdisc)
+            if args.verbose:
+                print("Set VPN interface txqueuelen=%s, qdisc=%s." % (args.txqueuelen or 'default', args.qdisc or 'default'), file=stderr)
+        except (sp.CalledProcessError, OSError):
+            print("WARNING: failed to set txqueuelen=%s, qdisc=%s for VPN interface" % (args.txqueuelen or 'default', args.qdisc or 'default'), file=stderr)
+
+    # clamp TCP MSS of outgoing SYNs, to avoid PMTU black holes
+    if args.clamp_mss:
+        mss = mtu - 40 if args.clamp_mss == 'mtu' else args.clamp_mss
+        try:
+            providers['firewall'].configure_mss_clamp(env.tundev, mss)
+            if args.verbose:
+                print("Clamped TCP MSS on VPN interface to %s." % ('path MTU' if mss == 'pmtu' else mss), file=stderr)
+        except sp.CalledProcessError:
+            try:
+                providers['firewall'].deconfigure_mss_clamp(env.tundev)
+            except sp.CalledProcessError:
+                pass
+            print("WARNING: failed to clamp TCP MSS", file=stderr)
+
     # set IPv4, IPv6 addresses for tunnel device
     if env.myaddr:
         providers['route'].add_address(env.tundev, env.myaddr)
@@ -150,10 +337,16 @@ def do_connect(env, args, providers):
     # save routes for excluded subnets
     exc_subnets = [(dest, providers['route'].get_route(dest)) for dest in args.exc_subnets]
 
+    # create (or repoint) the nexthop object shared by all IPv4 routes
+    if args.nexthop_id is not None:
+        providers['route'].replace_nexthop(args.nexthop_id, dev=env.tundev)
+        if args.verbose:
+            print("Pointed nexthop object %d at VPN interface." % args.nexthop_id, file=stderr)
+
     # set up routes to the DNS and Windows name servers, subnets, and local aliases
     ns = env.dns + (env.nbns if args.nbns else [])
     for dest in chain(ns, args.subnets, args.aliases):
-        providers['route'].replace_route(dest, dev=env.tundev)
+        add_vpn_route(env, args, providers, dest)
     else:
         providers['route'].flush_cache()
         if args.verbose:
@@ -161,31 +354,39 @@ def do_connect(env, args, providers):
 
     # restore routes to excluded subnets
     for dest, exc_route in exc_subnets:
-        providers['route'].replace_route(dest, exc_route)
+        providers['route'].replace_route(
+            dest, table=args.table, **{k: exc_route.get(k) for k in ('via', 'dev', 'src', 'mtu')})
     else:
         providers['route'].flush_cache()
         if args.verbose:
             print("Restored routes for %d excluded subnets." % len(exc_subnets), file=stderr)
 
-def do_post_connect(env, args, providers):
-    # lookup named hosts for which we need routes and/or host_map entries
-    # (the DNS/NBNS servers already have their routes)
-    ip_routes = set()
-    host_map = []
-
-    if args.ns_hosts:
-        ns_names = [ (ip, ('dns%d.%s' % (ii, args.name),)) for ii, ip in enumerate(env.dns) ]
-        if args.nbns:
-            ns_names += [ (ip, ('nbns%d.%s' % (ii, args.name),)) for ii, ip in enumerate(env.nbns) ]
-        host_map += ns_names
+    # only send designated users' and cgroups' traffic to the VPN routing table
+    if args.table:
+        for cgroup in args.cgroup:
+            try:
+                providers['firewall'].configure_cgroup_mark(env.tundev, cgroup, args.fwmark)
+            except sp.CalledProcessError:
+                try:
+                    providers['firewall'].deconfigure_cgroup_mark(env.tundev, cgroup, args.fwmark)
+                except sp.CalledProcessError:
+                    pass
+                print("WARNING: failed to mark traffic from cgroup %s" % cgroup, file=stderr)
+        rules = policy_rules(env, args)
+        for rule in rules:
+            try:
+                providers['route'].add_rule(args.table, **rule)
+            except sp.CalledProcessError:
+                print("WARNING: failed to add policy routing rule %r for table %s" % (rule, args.table), file=stderr)
         if args.verbose:
-            print("Adding /etc/hosts entries for %d nameservers..." % len(ns_names), file=stderr)
-            for ip, names in ns_names:
-                print("  %s = %s" % (ip, ', '.join(map(str, names))), file=stderr)
+            print("Added %d policy routing rules for table %s, marking traffic from %d cgroups." % (len(rules), args.table, len(args.cgroup)), file=stderr)
 
+def lookup_hosts(env, args, providers, hosts):
+    # returns a dict mapping each successfully looked-up host to its addresses
+    lookups = {}
     if args.verbose:
-        print("Looking up %d hosts using VPN DNS servers..." % len(args.hosts), file=stderr)
-    for host in args.hosts:
+        print("Looking up %d hosts using VPN DNS servers..." % len(hosts), file=stderr)
+    for host in hosts:
         ips = providers['dns'].lookup_host(
                 host, dns_servers=env.dns, search_domains=args.domain,
                 bind_address=env.myaddr)
@@ -194,12 +395,94 @@ def do_post_connect(env, args, providers):
         else:
             if args.verbose:
                 print("  %s = %s" % (host, ', '.join(map(str, ips))), file=stderr)
-            ip_routes.update(ips)
-            if args.host_names:
-                names = names_for(host, args.domain, args.short_names)
-                host_map.extend((ip, names) for ip in ips)
+            lookups[host] = ips
+    return lookups
+
+def transfer_zones(env, args, providers, zones):
+    # zones maps each zone to its serial and a dict of its hosts' addresses,
+    # which are updated in place; returns True if any of them changed
+    changed = False
+    for zone in args.zone:
+        serial, hosts = zones.get(zone, (None, {}))
+        result = providers['dns'].lookup_zone(
+                zone, dns_servers=env.dns, bind_address=env.myaddr,
+                serial=serial, pattern=args.zone_filter)
+        if result is None:
+            print("WARNING: Transfer of zone %s from VPN DNS servers failed." % zone, file=stderr)
+            continue
+
+        new_serial, records, deleted = result
+        if deleted is None:
+            hosts = {}
+        else:
+            for name, ip in deleted:
+                hosts.get(name, set()).discard(ip)
+                if not hosts.get(name, True):
+                    del hosts[name]
+        for name, ip in records:
+            hosts.setdefault(name, set()).add(ip)
+        zones[zone] = (new_serial, hosts)
+        changed = changed or deleted is None or bool(records or deleted)
+
+        if args.verbose:
+            if deleted is None:
+                print("Transferred zone %s (serial %d): %d matching hosts." % (zone, new_serial, len(hosts)), file=stderr)
+            elif new_serial != serial:
+                print("Updated zone %s (serial %d => %d): %d records added, %d deleted." % (zone, serial, new_serial, len(records), len(deleted)), file=stderr)
+    return changed
+
+def ns_host_map(env, args):
+    ns_names = [ (ip, ('dns%d.%s' % (ii, args.name),)) for ii, ip in enumerate(env.dns) ]
+    if args.nbns:
+        ns_names += [ (ip, ('nbns%d.%s' % (ii, args.name),)) for ii, ip in enumerate(env.nbns) ]
+    return ns_names
+
+def make_host_map(env, args, state):
+    host_map = ns_host_map(env, args) if args.ns_hosts else []
+    if args.host_names:
+        for host, ips in chain(state.lookups.items(), *(hosts.items() for serial, hosts in state.zones.values())):
+            names = names_for(host, args.domain, args.short_names)
+            host_map.extend((ip, names) for ip in ips)
     for ip, aliases in args.aliases.items():
         host_map.append((ip, aliases))
+    return host_map
+
+def vpn_dests(args, state):
+    # all destinations that should be routed to the VPN, except the nameservers
+    ips = chain.from_iterable(chain(state.lookups.values(), *(hosts.values() for serial, hosts in state.zones.values())))
+    return set(chain(args.subnets, args.aliases, ips))
+
+def update_routes(env, args, providers, old_dests):
+    # the nameservers keep their routes regardless
+    ns = env.dns + (env.nbns if args.nbns else [])
+    new_dests = vpn_dests(args, env.state)
+    added, removed = new_dests - old_dests, old_dests - new_dests - set(ns)
+    for dest in added:
+        try:
+            add_vpn_route(env, args, providers, dest)
+        except sp.CalledProcessError:
+            print("WARNING: could not add route to %s" % dest, file=stderr)
+    for dest in removed:
+        try:
+            remove_vpn_route(env, args, providers, dest)
+        except sp.CalledProcessError:
+            print("WARNING: could not delete route to %s" % dest, file=stderr)
+    if added or removed:
+        providers['route'].flush_cache()
+    return added, removed
+
+def do_post_connect(env, args, providers):
+    # lookup named hosts for which we need routes and/or host_map entries
+    # (the DNS/NBNS servers already have their routes)
+    if args.ns_hosts and args.verbose:
+        ns_names = ns_host_map(env, args)
+        print("Adding /etc/hosts entries for %d nameservers..." % len(ns_names), file=stderr)
+        for ip, names in ns_names:
+            print("  %s = %s" % (ip, ', '.join(map(str, names))), file=stderr)
+    env.state = state = slurpy(lookups=lookup_hosts(env, args, providers, args.hosts), zones={})
+    transfer_zones(env, args, providers, state.zones)
+    ip_routes = vpn_dests(args, state) - set(args.subnets) - set(args.aliases)
+    host_map = make_host_map(env, args, state)
 
     # add them to /etc/hosts
     if host_map:
@@ -209,12 +492,164 @@ def do_post_connect(env, args, providers):
 
     # add routes to hosts
     for ip in ip_routes:
-        providers['route'].replace_route(ip, dev=env.tundev)
+        add_vpn_route(env, args, providers, ip)
     else:
         providers['route'].flush_cache()
         if args.verbose:
             print("Added %d routes for named hosts." % len(ip_routes), file=stderr)
 
+def do_reload_routes(env, args, providers):
+    try:
+        routes = args.routes + read_routes_file(args.routes_file)
+    except (IOError, ValueError) as e:
+        print("WARNING: could not reload routes from %s: %s" % (args.routes_file, e), file=stderr)
+        return
+
+    lookups = env.state.lookups
+    old_dests = vpn_dests(args, env.state)
+    old_aliases = dict(args.aliases)
+    set_routes(args, env, routes)
+
+    # only look up new hosts, and forget removed ones
+    removed_hosts = [h for h in lookups if h not in args.hosts]
+    for host in removed_hosts:
+        del lookups[host]
+    added_hosts = [h for h in args.hosts if h not in lookups]
+    lookups.update(lookup_hosts(env, args, providers, added_hosts))
+
+    added, removed = update_routes(env, args, providers, old_dests)
+    if added_hosts or removed_hosts or args.aliases != old_aliases:
+        providers['hosts'].write_hosts(make_host_map(env, args, env.state), args.name)
+
+    if args.verbose:
+        print("Reloaded routes from %s: added %d and removed %d routes, looked up %d new hosts." % (
+            args.routes_file, len(added), len(removed), len(added_hosts)), file=stderr)
+
+def do_refresh_zones(env, args, providers):
+    old_dests = vpn_dests(args, env.state)
+    if transfer_zones(env, args, providers, env.state.zones):
+        added, removed = update_routes(env, args, providers, old_dests)
+        providers['hosts'].write_hosts(make_host_map(env, args, env.state), args.name)
+        if args.verbose:
+            print("Refreshed zones: added %d and removed %d routes." % (len(added), len(removed)), file=stderr)
+
+def intended_routes(env, args):
+    # map each destination that we routed to the VPN, or the gateway, to
+    # the device and table it should be in (None if in any)
+    vpn_table = None if args.table and not args.table.isdigit() else int(args.table or 254)
+    ns = env.dns + (env.nbns if args.nbns else [])
+    routes = {ip_network(dest): (env.tundev, vpn_table) for dest in chain(ns, vpn_dests(args, env.state))}
+    routes[ip_network(env.gateway)] = (env.gateway_route.get('dev'), 254)
+    return routes
+
+def missing_routes(env, args, changes):
+    # destinations whose routes were deleted, or replaced to point elsewhere
+    intended = intended_routes(env, args)
+    if changes is None:
+        return set(intended)
+    missing = set()
+    for c in changes:
+        if 'nexthop' in c:
+            # all of our IPv4 VPN routes used the deleted nexthop object
+            if c['nexthop'] == args.nexthop_id:
+                gateway = ip_network(env.gateway)
+                missing.update(d for d in intended if d.version == 4 and d != gateway)
+            continue
+        if c['destination'] not in intended:
+            continue
+        dev, table = intended[c['destination']]
+        if table is not None and c['table'] != table:
+            continue
+        if c['event'] == 'add' and c['dev'] in (None, dev):
+            continue
+        if c['event'] == 'del' and c['dev'] not in (None, dev):
+            continue
+        missing.add(c['destination'])
+    return missing
+
+def do_repair_routes(env, args, providers, missing):
+    intended = intended_routes(env, args)
+    gateway = ip_network(env.gateway)
+    repaired = 0
+
+    # recreate the nexthop object, in case it was deleted along with its routes
+    if args.nexthop_id is not None:
+        try:
+            providers['route'].replace_nexthop(args.nexthop_id, dev=env.tundev)
+        except sp.CalledProcessError:
+            print("WARNING: could not recreate nexthop object %d" % args.nexthop_id, file=stderr)
+
+    for dest in missing & set(intended):
+        try:
+            if dest == gateway:
+                providers['route'].replace_route(
+                    env.gateway, **{k: env.gateway_route.get(k) for k in ('via', 'dev', 'src', 'mtu')})
+            else:
+                add_vpn_route(env, args, providers, dest)
+        except sp.CalledProcessError:
+            print("WARNING: could not repair route to %s" % dest, file=stderr)
+        else:
+            repaired += 1
+    if repaired:
+        providers['route'].flush_cache()
+    env.state.repairs += repaired
+    if args.verbose:
+        print("Repaired %d routes removed or replaced by another program (%d in total)." % (repaired, env.state.repairs), file=stderr)
+
+def do_watch(env, args, providers, debounce=1.0, interval=5.0, repair_interval=2.0):
+    watchers = []
+    if args.watch:
+        watchers.append(providers['watch'])
+        providers['watch'].watch_file(args.routes_file)
+        if args.verbose:
+            print("Watching %s for changes..." % args.routes_file, file=stderr)
+    if args.repair_routes:
+        watchers.append(providers['monitor'])
+        providers['monitor'].start_monitor()
+        env.state.repairs = 0
+        if args.verbose:
+            print("Monitoring routes for removal by other programs...", file=stderr)
+    next_refresh = time() + args.zone_refresh if args.zone_refresh else None
+    # repairs are batched, and no more frequent than repair_interval
+    missing, next_repair = set(), time()
+
+    while True:
+        deadlines = [time() + interval]
+        if next_refresh is not None:
+            deadlines.append(next_refresh)
+        if missing:
+            deadlines.append(next_repair)
+        ready = select(watchers, [], [], max(0, min(deadlines) - time()))[0]
+
+        if next_refresh is not None and time() >= next_refresh:
+            do_refresh_zones(env, args, providers)
+            next_refresh = time() + args.zone_refresh
+
+        if args.repair_routes and providers['monitor'] in ready:
+            missing |= missing_routes(env, args, providers['monitor'].read_changes())
+
+        # stop once the tunnel device is gone
+        if not ready or missing:
+            try:
+                providers['route'].get_link_info(env.tundev)
+            except sp.CalledProcessError:
+                break
+
+        if missing and time() >= next_repair:
+            do_repair_routes(env, args, providers, missing)
+            missing, next_repair = set(), time() + repair_interval
+
+        if not (args.watch and providers['watch'] in ready and providers['watch'].read_changes()):
+            continue
+
+        # coalesce rapid edits, until the file has been quiet for a while
+        while select([providers['watch']], [], [], debounce)[0]:
+            providers['watch'].read_changes()
+        do_reload_routes(env, args, providers)
+
+    if args.repair_routes and args.verbose:
+        print("Repaired %d routes in total." % env.state.repairs, file=stderr)
+
 ########################################
 
 # Translate environment variables which may be passed by our caller
@@ -287,43 +722,87 @@ def parse_env(environ=os.environ):
 def parse_args_and_env(args=None, environ=os.environ):
     p = argparse.ArgumentParser()
     p.add_argument('routes', nargs='*', type=net_or_host_param, help='List of VPN-internal hostnames, subnets (e.g. 192.168.0.0/24), or aliases (e.g. host1=192.168.1.2) to add to routing and /etc/hosts.')
+    p.add_argument('-f','--routes-file', default=None, help='File containing additional routes, in the same format and separated by whitespace (# starts a comment)')
     g = p.add_argument_group('Subprocess options')
     p.add_argument('-k','--kill', default=[], action='append', help='File containing PID to kill before disconnect (may be specified multiple times)')
+    p.add_argument('--kill-timeout', type=float, default=3, metavar='SECONDS', help='How long to wait for killed processes to exit on disconnect before sending SIGKILL (default %(default)s)')
     g = p.add_argument_group('Informational options')
     g.add_argument('--banner', action='store_true', help='Print banner message (default is to suppress it)')
     g = p.add_argument_group('Routing and hostname options')
     g.add_argument('-i','--incoming', action='store_true', help='Allow incoming traffic from VPN (default is to block)')
+    g.add_argument('--clamp-mss', type=mss_param, default=None, metavar='pmtu|mtu|MSS', help="Clamp MSS of outgoing TCP SYNs on the VPN interface to the path MTU, to the VPN interface's MTU minus 40, or to a fixed value (IPv4 only; IPv6 connections are not clamped)")
     g.add_argument('-n','--name', default=None, help='Name of this VPN (default is $TUNDEV)')
     g.add_argument('-d','--domain', action='append', help='Search domain inside the VPN (default is $CISCO_DEF_DOMAIN)')
     g.add_argument('-I','--route-internal', action='store_true', help="Add route for VPN's default subnet (passed in as $INTERNAL_IP*_NET*")
     g.add_argument('-S','--route-splits', action='store_true', help="Add route for VPN's split-tunnel subnets (passed in via $CISCO_SPLIT_*)")
     g.add_argument('--no-host-names', action='store_false', dest='host_names', default=True, help='Do not add either short or long hostnames to /etc/hosts')
     g.add_argument('--no-short-names', action='store_false', dest='short_names', default=True, help="Only add long/fully-qualified domain names to /etc/hosts")
+    g = p.add_argument_group('Tunnel device options')
+    g.add_argument('--txqueuelen', type=int, default=None, help='Transmit queue length of the VPN interface (default is to leave it unchanged)')
+    g.add_argument('--qdisc', default=None, help='Root queueing discipline of the VPN interface, e.g. fq or fq_codel (default is to leave it unchanged)')
+    g.add_argument('--nexthop-id', type=int, default=None, metavar='ID', help='Point IPv4 VPN routes at a shared kernel nexthop object with this ID, so that they can be moved or removed all at once')
+    g = p.add_argument_group('Policy routing options')
+    g.add_argument('--table', default=None, help='Add VPN routes to this routing table, used only by traffic from --uid-range and --cgroup (default is the main table, used by all traffic)')
+    g.add_argument('--uid-range', default=[], action='append', type=uidrange_param, metavar='FIRST[-LAST]', help='Send traffic from processes with UIDs in this range to the VPN routing table (may be specified multiple times)')
+    g.add_argument('--cgroup', default=[], action='append', metavar='PATH', help='Send traffic from processes in this (v2) cgroup to the VPN routing table, by marking it with --fwmark (may be specified multiple times)')
+    g.add_argument('--fwmark', default=None, help='Firewall mark for traffic from --cgroup')
+    g = p.add_argument_group('Multipath options')
+    g.add_argument('-M','--multipath', metavar='GROUP', default=None, help='Share routes with other tunnels in the named GROUP, as weighted multipath (ECMP) routes across all their devices (also the default VPN name). IPv4 only: IPv6 routes always use the most recently connected device')
+    g.add_argument('--weight', type=int, default=1, help='Weight of this tunnel in the multipath routes (default %(default)s)')
     g = p.add_argument_group('Nameserver options')
     g.add_argument('--no-ns-hosts', action='store_false', dest='ns_hosts', default=True, help='Do not add nameserver aliases to /etc/hosts (default is to name them dns0.tun0, etc.)')
     g.add_argument('--nbns', action='store_true', dest='nbns', help='Include NBNS (Windows/NetBIOS nameservers) as well as DNS nameservers')
+    g.add_argument('-z','--zone', default=[], action='append', help='Add hosts from this zone (transferred from VPN DNS servers with AXFR) to routing and /etc/hosts (may be specified multiple times)')
+    g.add_argument('--zone-filter', default='*', metavar='PATTERN', help='Only add hosts from --zone whose names match this shell-style pattern (default %(default)r)')
+    g.add_argument('--zone-refresh', type=float, default=None, metavar='SECONDS', help='Keep running after connect, and update the hosts from --zone with IXFR at this interval')
     g = p.add_argument_group('Debugging options')
     g.add_argument('-v','--verbose', action='store_true', help="Explain what %(prog)s is doing")
     g.add_argument('-D','--dump', action='store_true', help='Dump environment variables passed by caller')
     g.add_argument('--no-fork', action='store_false', dest='fork', help="Don't fork and continue in background on connect")
+    g.add_argument('-w','--watch', action='store_true', help="Keep running after connect, and apply changes to --routes-file as it is edited")
+    g.add_argument('--repair-routes', action='store_true', help="Keep running after connect, and reinstall routes which other programs remove or replace")
     p.add_argument('-V','--version', action='version', version='%(prog)s ' + __version__)
     args = p.parse_args(args)
+    if not 1 <= args.weight <= 256:
+        p.error("--weight must be between 1 and 256")
     env = parse_env(environ)
 
-    # use the tunnel device as the VPN name if unspecified
+    # use the multipath group or tunnel device as the VPN name if unspecified
     if args.name is None:
-        args.name = env.tundev
+        args.name = args.multipath or env.tundev
 
     # use the list from the env if --domain wasn't specified, but start with an
     # empty list if it was specified; hence can't use 'default' here:
     if args.domain is None:
         args.domain = env.domain
 
+    if args.watch and not args.routes_file:
+        p.error("--watch requires --routes-file")
+    if args.zone_refresh and not args.zone:
+        p.error("--zone-refresh requires --zone")
+    if (args.uid_range or args.cgroup) and not args.table:
+        p.error("--uid-range and --cgroup require --table")
+    if args.cgroup and not args.fwmark:
+        p.error("--cgroup requires --fwmark")
+    if args.multipath and args.nexthop_id is not None:
+        p.error("--nexthop-id cannot be combined with --multipath")
+    routes = args.routes
+    if args.routes_file:
+        try:
+            routes = routes + read_routes_file(args.routes_file)
+        except (IOError, ValueError) as e:
+            p.error("could not read routes from %s: %s" % (args.routes_file, e))
+
+    set_routes(args, env, routes)
+    return p, args, env
+
+# Classify routes into subnets, hosts, and aliases, and add those from the environment
+def set_routes(args, env, routes):
     args.subnets = []
     args.exc_subnets = []
     args.hosts = []
     args.aliases = {}
-    for x in args.routes:
+    for x in routes:
         if isinstance(x, (IPv4Network, IPv6Network)):
             args.subnets.append(x)
         elif isinstance(x, str):
@@ -337,7 +816,6 @@ def parse_args_and_env(args=None, environ=os.environ):
     if args.route_splits:
         args.subnets.extend(env.splitinc)
         args.exc_subnets.extend(env.splitexc)
-    return p, args, env
 
 def main():
     p, args, env = parse_args_and_env()
@@ -345,6 +823,20 @@ def main():
         p.error("Must be called as vpnc-script, with $reason set")
 
     providers = get_default_providers()
+    if args.watch and 'watch' not in providers:
+        p.error("--watch is not supported on your platform, {}".format(platform))
+    if args.repair_routes and 'monitor' not in providers:
+        p.error("--repair-routes is not supported on your platform, {}".format(platform))
+    for option, used, kind, base, method in (
+            ('--multipath', args.multipath, 'route', RouteProvider, 'add_multipath_route'),
+            ('--nexthop-id', args.nexthop_id is not None, 'route', RouteProvider, 'replace_nexthop'),
+            ('--table', args.table, 'route', RouteProvider, 'add_rule'),
+            ('--cgroup', args.cgroup, 'firewall', FirewallProvider, 'configure_cgroup_mark'),
+            ('--clamp-mss', args.clamp_mss, 'firewall', FirewallProvider, 'configure_mss_clamp'),
+            ('--txqueuelen', args.txqueuelen is not None, 'route', RouteProvider, 'set_link_queue'),
+            ('--qdisc', args.qdisc, 'route', RouteProvider, 'set_link_queue')):
+        if used and not provider_supports(providers[kind], base, method):
+            p.error("{} is not supported on your platform, {}".format(option, platform))
 
     if args.dump:
         ppid = providers['process'].ppid_of(None)
@@ -392,11 +884,32 @@ def main():
         do_connect(env, args, providers)
 
         # we continue running in a new child process, so the VPN can actually
-        # start in the background, because we need to actually send traffic to it
-        if args.fork and os.fork():
-            raise SystemExit
-
-        do_post_connect(env, args, providers)
+        # start in the background, because we need to actually send traffic to it;
+        # the post-connect worker is registered for this tunnel before we return
+        # to our caller, so that do_disconnect can always find and cancel it
+        pidfile = worker_pidfile(env)
+        if args.fork:
+            ready, registered = os.pipe()
+            pid = os.fork()
+            if pid:
+                write_worker_pidfile(env, providers, pid)
+                raise SystemExit
+            # wait until our parent has registered us
+            os.close(registered)
+            os.read(ready, 1)
+            os.close(ready)
+        else:
+            write_worker_pidfile(env, providers, os.getpid())
+        try:
+            do_post_connect(env, args, providers)
+            if args.watch or args.zone_refresh or args.repair_routes:
+                do_watch(env, args, providers)
+        finally:
+            try:
+                if read_worker_pidfile(env)[0] == os.getpid():
+                    os.remove(pidfile)
+            except (IOError, ValueError):
+                pass
 
 if __name__=='__main__':
     main()
@@ -1,6 +1,8 @@
 import fcntl
 import os
 import subprocess
+from fnmatch import fnmatchcase
+from signal import SIGTERM, SIG_BLOCK, SIG_SETMASK, pthread_sigmask
 from ipaddress import ip_address
 
 from .provider import DNSProvider, HostsProvider
@@ -40,6 +42,74 @@ class DigProvider(DNSProvider):
 
         return result or None
 
+    def lookup_zone(self, zone, dns_servers, *, bind_address=None, serial=None, pattern='*'):
+        cl = [self.dig, '+noall', '+answer']
+        if bind_address:
+            cl.extend(('-b', str(bind_address)))
+        cl.extend((zone, 'axfr' if serial is None else 'ixfr={:d}'.format(serial)))
+        pattern = pattern.lower()
+
+        # Try each server in turn, until one allows the transfer.
+        for server in dns_servers:
+            p = subprocess.Popen(cl + ['@{!s}'.format(server)], stdout=subprocess.PIPE)
+            result = self._parse_zone_transfer(p.stdout, serial, pattern)
+            p.stdout.close()
+            if p.wait() == 0 and result is not None:
+                return result
+        return None
+
+    @staticmethod
+    def _parse_zone_transfer(lines, serial, pattern):
+        # Both AXFR and IXFR responses start and end with the SOA of the new
+        # version of the zone. In an IXFR response, each SOA in between starts
+        # alternately a list of deleted and a list of added records.
+        # Records are filtered as they are streamed from dig, so only the
+        # matching ones are ever held in memory. The deltas are combined as
+        # they are read: the first change to a record shows whether it existed
+        # before serial, and the last whether it exists now, so a record added
+        # by one delta and deleted by a later one drops out entirely.
+        new_serial = incremental = None
+        changes = {}    # record: [existed before, exists now]
+        adding, nsoa, complete = True, 0, False
+        for line in lines:
+            words = line.decode().split()
+            if len(words) < 5 or words[0].startswith(';'):
+                continue
+            name, rtype, rdata = words[0].rstrip('.').lower(), words[3], words[4:]
+
+            if rtype == 'SOA':
+                nsoa += 1
+                s = int(rdata[2])
+                if nsoa == 1:
+                    # a lone SOA means the zone is unchanged since serial
+                    new_serial = s
+                    complete = serial is not None and s == serial
+                elif incremental is False or (incremental is None and (serial is None or s == new_serial)):
+                    # the end of an AXFR; the second SOA of an IXFR would
+                    # instead have the old serial
+                    complete = True
+                else:
+                    incremental = True
+                    adding = not adding
+                    complete = not adding and s == new_serial
+            elif nsoa == 0 or complete:
+                continue
+            else:
+                if incremental is None:
+                    incremental = False
+                if rtype in ('A', 'AAAA') and fnmatchcase(name, pattern):
+                    try:
+                        record = (name, ip_address(rdata[0]))
+                    except ValueError:
+                        continue
+                    changes.setdefault(record, [not adding, adding])[1] = adding
+
+        if not complete:
+            return None
+        added = [r for r, (before, now) in changes.items() if now and not before]
+        deleted = [r for r, (before, now) in changes.items() if before and not now]
+        return new_serial, added, deleted if incremental or nsoa == 1 else None
+
 
 class HostsFileProvider(HostsProvider):
     def __init__(self, path):
@@ -49,6 +119,14 @@ class HostsFileProvider(HostsProvider):
 
     def write_hosts(self, host_map, name):
         tag = 'vpn-slice-{} AUTOCREATED'.format(name)
+        # don't let the post-connect worker be killed halfway through rewriting the file
+        oldmask = pthread_sigmask(SIG_BLOCK, {SIGTERM})
+        try:
+            return self._write_hosts(host_map, tag)
+        finally:
+            pthread_sigmask(SIG_SETMASK, oldmask)
+
+    def _write_hosts(self, host_map, tag):
         with open(self.path, 'r+') as hostf:
             fcntl.flock(hostf, fcntl.LOCK_EX)  # POSIX only, obviously
             lines = hostf.readlines()
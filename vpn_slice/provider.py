@@ -1,4 +1,7 @@
+import os
 from abc import ABCMeta, abstractmethod
+from signal import SIGTERM
+from time import sleep, time
 
 
 class ProcessProvider(metaclass=ABCMeta):
@@ -12,17 +15,54 @@ class ProcessProvider(metaclass=ABCMeta):
         or of the current process if None."""
 
     @abstractmethod
-    def kill(self, pid):
+    def start_time_of(self, pid):
+        """Get an opaque string identifying when the process with the
+        given PID started, or None if there is no such process.
+
+        Together with the PID, this identifies a process even after its
+        PID has been reused."""
+
+    @abstractmethod
+    def kill(self, pid, signal=SIGTERM):
         """Kill the process with the given PID."""
 
+    def terminate(self, pid, timeout, signal=SIGTERM, start_time=None):
+        """Kill the process with the given PID, and wait for it to exit.
+
+        Return True if it exited within timeout seconds.
+
+        If start_time is specified, the process is only killed if it is
+        the one that start_time_of identified; otherwise, as when there
+        is no such process, ProcessLookupError is raised.
+
+        Base class behavior is to poll for the existence of the PID.
+
+        """
+        if start_time is not None and self.start_time_of(pid) != start_time:
+            raise ProcessLookupError("process %d has exited, or its PID was reused" % pid)
+        self.kill(pid, signal)
+        deadline = time() + timeout
+        while True:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            if time() >= deadline:
+                return False
+            sleep(0.05)
+
 
 class RouteProvider(metaclass=ABCMeta):
     @abstractmethod
-    def add_route(self, destination, *, via=None, dev=None, src=None, mtu=None):
+    def add_route(self, destination, *, via=None, dev=None, src=None, mtu=None, table=None, nhid=None):
         """Add a route to a destination.
 
-        You must specify a device or gateway saying where to route to.
-        If both are specified, they must agree.
+        You must specify a device or gateway saying where to route to,
+        or the ID of a nexthop object created with replace_nexthop.
+        If both a device and gateway are specified, they must agree.
+
+        If a table is specified, the route is added to that routing
+        table rather than the main one.
 
         Implementations may fail if a route that already exists is
         added again.
@@ -30,11 +70,15 @@ class RouteProvider(metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def replace_route(self, destination, *, via=None, dev=None, src=None, mtu=None):
+    def replace_route(self, destination, *, via=None, dev=None, src=None, mtu=None, table=None, nhid=None):
         """Add or replace a route to a destination.
 
-        You must specify a device or gateway saying where to route to.
-        If both are specified, they must agree.
+        You must specify a device or gateway saying where to route to,
+        or the ID of a nexthop object created with replace_nexthop.
+        If both a device and gateway are specified, they must agree.
+
+        If a table is specified, the route is added to that routing
+        table rather than the main one.
 
         Implementations should not fail if a route that already exists
         is added again.
@@ -42,8 +86,9 @@ class RouteProvider(metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def remove_route(self, destination):
-        """Remove a route to a destination."""
+    def remove_route(self, destination, *, table=None):
+        """Remove a route to a destination (from a routing table other than
+        the main one, if specified)."""
 
     @abstractmethod
     def get_route(self, destination):
@@ -83,6 +128,91 @@ class RouteProvider(metaclass=ABCMeta):
     def add_address(self, device, address):
         """Add an address to an interface."""
 
+    def set_link_queue(self, device, *, txqueuelen=None, qdisc=None):
+        """Set the transmit queue length and/or the root queueing
+        discipline (e.g. fq or fq_codel) of a device.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("setting the transmit queue is not supported on this platform")
+
+    def add_multipath_route(self, destination, *, dev, weight=1, table=None):
+        """Add a device as one weighted nexthop of a multipath route.
+
+        Any nexthops already present in the route to the destination
+        (e.g. other tunnels in the same group) are preserved.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("multipath routes are not supported on this platform")
+
+    def remove_multipath_route(self, destination, *, dev, table=None):
+        """Remove a device from the nexthops of a multipath route.
+
+        The route is deleted entirely if no nexthops remain. Return the
+        number of nexthops remaining.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("multipath routes are not supported on this platform")
+
+    def get_multipath_routes(self, dev, table=None):
+        """Return the destinations of multipath routes having a nexthop on a device.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("multipath routes are not supported on this platform")
+
+    def replace_nexthop(self, nhid, *, via=None, dev=None):
+        """Add or replace an (IPv4) nexthop object, which routes can share.
+
+        Replacing it repoints all routes using it at once.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("nexthop objects are not supported on this platform")
+
+    def remove_nexthop(self, nhid):
+        """Remove a nexthop object, along with all routes using it.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("nexthop objects are not supported on this platform")
+
+    def flush_table(self, table):
+        """Remove all routes from a routing table other than the main one.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("routing tables are not supported on this platform")
+
+    def add_rule(self, table, *, uidrange=None, fwmark=None, src=None):
+        """Add a policy routing rule selecting a routing table.
+
+        The rule matches traffic from processes with UIDs in the range
+        (a (first, last) tuple), with the firewall mark, and/or from
+        the source address specified.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("policy routing is not supported on this platform")
+
+    def remove_rule(self, table, *, uidrange=None, fwmark=None, src=None):
+        """Remove a policy routing rule added by add_rule.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("policy routing is not supported on this platform")
+
 
 class FirewallProvider(metaclass=ABCMeta):
     @abstractmethod
@@ -93,12 +223,74 @@ class FirewallProvider(metaclass=ABCMeta):
     def deconfigure_firewall(self, device):
         """Remove the firewall configuration for a device."""
 
+    def configure_mss_clamp(self, device, mss):
+        """Clamp the MSS of IPv4 TCP SYNs sent out through the device.
+
+        mss is either an integer MSS, or 'pmtu' to clamp to the
+        path MTU.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("TCP MSS clamping is not supported on this platform")
+
+    def deconfigure_mss_clamp(self, device):
+        """Remove any TCP MSS clamping for a device.
+
+        Return the number of clamping rules removed.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("TCP MSS clamping is not supported on this platform")
+
+    def configure_cgroup_mark(self, device, cgroup, fwmark):
+        """Set a firewall mark on traffic from processes in a cgroup.
+
+        Marked traffic sent out through the device is also masqueraded,
+        since its source address was chosen before it was marked.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("marking traffic by cgroup is not supported on this platform")
+
+    def deconfigure_cgroup_mark(self, device, cgroup, fwmark):
+        """Remove the firewall configuration added by configure_cgroup_mark.
+
+        Base class behavior is to raise NotImplementedError.
+
+        """
+        raise NotImplementedError("marking traffic by cgroup is not supported on this platform")
+
 
 class DNSProvider(metaclass=ABCMeta):
     @abstractmethod
     def lookup_host(self, hostname, dns_servers, *, bind_address=None, search_domains=()):
         """Look up the address of a host."""
 
+    @abstractmethod
+    def lookup_zone(self, zone, dns_servers, *, bind_address=None, serial=None, pattern='*'):
+        """Look up the addresses of all hosts in a zone, using a zone transfer.
+
+        If serial is None, transfer the whole zone (AXFR). Otherwise,
+        request only the changes since that serial (IXFR); the server
+        may still respond with the whole zone.
+
+        Only address records with names matching the shell-style
+        pattern are included. Return None if the transfer fails, or a
+        tuple of:
+
+        * the new serial of the zone
+        * a list of (name, address) tuples added
+        * a list of (name, address) tuples deleted, or None if the
+          whole zone was transferred
+
+        The lists are the net changes since serial, and are disjoint,
+        so they can be applied in either order.
+
+        """
+
 
 class HostsProvider(metaclass=ABCMeta):
     @abstractmethod
@@ -112,6 +304,58 @@ class HostsProvider(metaclass=ABCMeta):
 
         """
 
+
+class FileWatchProvider(metaclass=ABCMeta):
+    @abstractmethod
+    def watch_file(self, path):
+        """Start watching a file for changes, including its replacement
+        by another file (as many editors do)."""
+
+    @abstractmethod
+    def fileno(self):
+        """Return a file descriptor which becomes readable when a watched
+        file may have changed, for use with select()."""
+
+    @abstractmethod
+    def read_changes(self):
+        """Consume pending notifications without blocking.
+
+        Return True if any watched file has changed.
+
+        """
+
+
+class RouteMonitorProvider(metaclass=ABCMeta):
+    @abstractmethod
+    def start_monitor(self):
+        """Start receiving notifications of changes to the routing tables."""
+
+    @abstractmethod
+    def fileno(self):
+        """Return a file descriptor which becomes readable when routes
+        have changed, for use with select()."""
+
+    @abstractmethod
+    def read_changes(self):
+        """Consume pending notifications without blocking.
+
+        Return a list of dicts with these keys, or None if some
+        notifications were lost:
+
+        * event ('add' or 'del')
+        * destination (an IP network)
+        * dev (or None, e.g. for multipath routes)
+        * table (a number)
+
+        Deletion of a nexthop object, which silently deletes all routes
+        using it, is instead reported with these keys:
+
+        * event ('del')
+        * nexthop (its ID)
+
+        """
+
+
 class TunnelPrepProvider:
     def prepare_tunnel(self):
         """Prepare operating system to create tunnel devices.